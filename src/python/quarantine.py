@@ -2,10 +2,16 @@
 
 import os
 import sys
+import copy
 import json
+import heapq
+import atexit
 import logging
+import operator
 
 from typing import List
+from functools import lru_cache, cached_property
+from collections import defaultdict
 from time import sleep
 from random import seed, randrange
 
@@ -14,21 +20,76 @@ import yaml
 import vmtconnect
 import configargparse
 
+# pyVmomi and pyVim are imported by the vCenter classes when they are used,
+# since most runs never touch vCenter.
 # import com.vmware.cis.tagging_client
-from pyVmomi import vim, vmodl
-from pyVim.connect import SmartConnectNoSSL, Disconnect
 
-try:
-    import iso8601
-    def read_isodate(date):
-        return iso8601.parse_date(date)
-except ModuleNotFoundError:
+
+def _import_isodate_parser():
+    try:
+        import udatetime
+        return udatetime.from_string
+    except ModuleNotFoundError:
+        pass
+    try:
+        import iso8601
+        return iso8601.parse_date
+    except ModuleNotFoundError:
+        pass
     try:
         import dateutil.parser
-        def read_isodate(date):
-            return dateutil.parser.parse(date)
+        return dateutil.parser.parse
     except ModuleNotFoundError:
-        raise Exception('Unable to import pyiso8601 or python-dateutil.')
+        raise Exception(
+            'Unable to import udatetime, pyiso8601 or python-dateutil.')
+
+
+_isodate_parser = None
+
+
+def read_isodate(date):
+    """Parse an RFC3339 date string into a :obj:`datetime`.
+
+    The parser module is imported on the first call.
+    """
+    global _isodate_parser
+    if _isodate_parser is None:
+        _isodate_parser = _import_isodate_parser()
+    return _isodate_parser(date)
+
+try:
+    import orjson
+    def read_json(data):
+        return orjson.loads(data)
+    def write_json(obj):
+        # vmtconnect expects the DTO as a str
+        return orjson.dumps(obj).decode()
+except ModuleNotFoundError:
+    read_json = json.loads
+    write_json = json.dumps
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+@lru_cache(maxsize=1)
+def _load_config(path, mtime_ns):
+    with open(path) as cfgfile:
+        return yaml.load(cfgfile, Loader=YamlLoader)
+
+
+def load_config(path):
+    """Load the yaml configuration file.
+
+    The parsed config is cached until the file's modification time changes,
+    and each caller receives its own copy.
+
+    Arguments:
+        path (str): Full file path to the yaml configuration file.
+    """
+    return copy.deepcopy(_load_config(path, os.stat(path).st_mtime_ns))
 
 
 class VmtJit:
@@ -77,6 +138,41 @@ class VmtJit:
         return self.vmt
 
 
+class VcenterJit:
+    """A thin wrapper for a pyVmomi service instance which delays the vCenter
+    login until it's actually required.
+
+    The connection is disconnected when the process exits.
+    """
+
+    def __init__(self, hostname, user, passwd):
+        """Initialize a :py:class:`~VcenterJit`.
+
+        Arguments:
+            hostname (str): Hostname or IP of the vCenter.
+            user (str): vCenter username.
+            passwd (str): vCenter password.
+        """
+        self.hostname = hostname
+        self.user = user
+        self.passwd = passwd
+        self.vc = None
+
+    def get_connection(self):
+        """Returns a pyVmomi service instance connected with the credentials
+        supplied on initialization.
+
+        The returned object is cached, so subsequent requests will return the
+        same service instance.
+        """
+        if not self.vc:
+            from pyVim.connect import SmartConnectNoSSL, Disconnect
+            self.vc = SmartConnectNoSSL(
+                host=self.hostname, user=self.user, pwd=self.passwd)
+            atexit.register(Disconnect, self.vc)
+        return self.vc
+
+
 class Event:
     """A thin wrapper for the VMT action DTO.
 
@@ -101,6 +197,14 @@ class Event:
         self.uuid = actionDto['uuid']
         self.result = actionDto.get('actionState')
         self.createTime = actionDto.get('createTime')
+        self._failed = int(
+            bool(self.result) and self.result.lower() == 'failed')
+
+    @cached_property
+    def _sortKey(self):
+        # Parsed on first use, since only attemptCount rules order events.
+        return read_isodate(self.createTime).timestamp() \
+            if self.createTime else 0.0
 
 
 class Patient:
@@ -167,7 +271,7 @@ class Patient:
         
     
         actions = vmt.request(
-            f'entities/{self.uuid}/actions', method='POST', dto=json.dumps(actionsDto))
+            f'entities/{self.uuid}/actions', method='POST', dto=write_json(actionsDto))
         return [Event(e) for e in actions]
 
 
@@ -180,12 +284,28 @@ class Ward:
         To be implemented by inheriting classes."""
         pass
 
+    def admit_many(self, patients: List[Patient]):
+        """Adds several patients to quarantine.
+
+        Inheriting classes may override this to add all patients at once,
+        by default each patient is admitted individually."""
+        for patient in patients:
+            self.admit(patient)
+
     def discharge(self, patient: Patient):
         """Removes a patient from quarantine.
 
         To be implemented by inheriting classes."""
         pass
 
+    def discharge_many(self, patients: List[Patient]):
+        """Removes several patients from quarantine.
+
+        Inheriting classes may override this to remove all patients at once,
+        by default each patient is discharged individually."""
+        for patient in patients:
+            self.discharge(patient)
+
     def discharge_eligible_patients(self) -> List[Patient]:  # type: ignore
         """Removes all patients from quarantine meeting the criteria.
 
@@ -233,20 +353,29 @@ class VmtWard(Ward):
         self.group_name = config['groupName']
         self.group_type = config['groupType']
         self.group = None
+        self._group_uuid = None
 
     def _get_group(self):
         if not self.group:
-            # group = self.vmtjit.get_session() \
-            #     .get_group_by_name(self.group_name)
-            group = self.vmtjit.get_session() \
-                .search(types=['Group'],q=self.group_name)
+            vmt = self.vmtjit.get_session()
+            # The search (and vmtconnect's get_group_by_name, which wraps it)
+            # matches substrings, so only an exact name match is accepted.
+            group = [
+                g for g in vmt.search(types=['Group'], q=self.group_name) or []
+                if g.get('displayName') == self.group_name]
             if not group:
-                self.group = self.vmtjit.get_session() \
-                    .add_static_group(self.group_name, self.group_type)[0]
+                self.group = vmt.add_static_group(
+                    self.group_name, self.group_type)[0]
             else:
                 self.group = group[0]
+            self._group_uuid = self.group['uuid']
         return self.group
 
+    def _get_group_uuid(self):
+        if not self._group_uuid:
+            self._get_group()
+        return self._group_uuid
+
     def admit(self, patient: Patient):
         """Add the patient (Entity) to the defined static group.
 
@@ -256,9 +385,21 @@ class VmtWard(Ward):
         Arguments:
             patient (:obj:`~Patient`): The patient (Entity) to quarantine.
         """
+        self.admit_many([patient])
+
+    def admit_many(self, patients: List[Patient]):
+        """Add several patients (Entities) to the defined static group.
+
+        The patients are added with a single `add_static_group_members` call.
+        If the group does not exist, it will be created as described in
+        :func:`~VmtWard.admit`
+
+        Arguments:
+            patients (list): The patients (Entities) to quarantine.
+        """
         vmt = self.vmtjit.get_session()
         vmt.add_static_group_members(
-            self._get_group()['uuid'], [patient.uuid])
+            self._get_group_uuid(), [p.uuid for p in patients])
 
     def discharge(self, patient: Patient):
         """Remove the patient (Entity) from the defined static group.
@@ -267,16 +408,30 @@ class VmtWard(Ward):
             patient (:obj:`~Patient`): The patient (Entity) to remove from
                 quarantine.
         """
+        self.discharge_many([patient])
+
+    def discharge_many(self, patients: List[Patient]):
+        """Remove several patients (Entities) from the defined static group.
+
+        The group members are fetched and updated once, regardless of the
+        number of patients.
+
+        Arguments:
+            patients (list): The patients (Entities) to remove from
+                quarantine.
+        """
         vmt = self.vmtjit.get_session()
-        group_uuid = self._get_group()['uuid']
+        group_uuid = self._get_group_uuid()
+        discharged = {p.uuid for p in patients}
         members = vmt.get_group_members(group_uuid)
-        new_members = [m for m in members if m['uuid'] != patient.uuid]
+        new_members = [
+            m['uuid'] for m in members if m['uuid'] not in discharged]
         vmt.update_static_group_members(group_uuid, new_members)
 
     def discharge_eligible_patients(self):
         """Remove all patients (Entities) from the defined static group."""
         vmt = self.vmtjit.get_session()
-        group_uuid = self._get_group()['uuid']
+        group_uuid = self._get_group_uuid()
         members = vmt.get_group_members(group_uuid)
         vmt.update_static_group_members(group_uuid, [])
         return [Patient(m) for m in members]
@@ -285,48 +440,23 @@ class VmtWard(Ward):
 class VcenterWard(Ward):
     def __init__(self, hostname, user, passwd, config):
         self.hostname = hostname
-        self.vc = SmartConnectNoSSL(host=self.hostname, user=user, pwd=passwd)
+        self.vcjit = VcenterJit(hostname, user, passwd)
+        from pyVmomi import vim, vmodl
+        self._vim, self._vmodl = vim, vmodl
         self.tag_category = config['tag']['category']
 
     def _findVm(self, patient: Patient):
-        # VM lookup adapted from Richard Stern's `vm_reset.py` which is
-        # adapted from https://github.com/vmware/pyvmomi-community-samples/blob/master/samples/tools/pchelper.py
-        view = self.vc.content.viewManager.CreateContainerView(
-            self.vc.content.rootFolder, [vim.VirtualMachine], True)
-
-        collector = self.vc.content.propertyCollector
-
-        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec()
-        traversal_spec.name = 'traverseEntities'
-        traversal_spec.path = 'view'
-        traversal_spec.skip = False
-        traversal_spec.type = view.__class__
-
-        obj_spec = vmodl.query.PropertyCollector.ObjectSpec()
-        obj_spec.selectSet = [traversal_spec]
-        obj_spec.obj = view
-        obj_spec.skip = True
-
-        property_spec = vmodl.query.PropertyCollector.PropertySpec()
-        property_spec.type = vim.VirtualMachine
-        property_spec.pathSet = ['name']
-
-        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
-        filter_spec.objectSet = [obj_spec]
-        filter_spec.propSet = [property_spec]
-
-        pset = collector.RetrieveContents([filter_spec])
-
-        idx = 0
-        for obj in pset:
-            print(idx)
-            idx = idx + 1
-            for x in obj.propSet:
-                print(f"{x.name}: {x.val}")
-            if obj.obj._moId == patient.vendorIds[self.hostname]:
-                return obj.obj
-
-        return None
+        # vCenter resolves a managed object reference from its MoID directly,
+        # so there is no need to walk the VM inventory. The name is read to
+        # confirm the VM still exists.
+        vm = self._vim.VirtualMachine(
+            patient.vendorIds[self.hostname],
+            stub=self.vcjit.get_connection()._stub)
+        try:
+            vm.name
+        except self._vmodl.fault.ManagedObjectNotFound:
+            return None
+        return vm
 
     def admit(self, patient: Patient):
         vm = self._findVm(patient)
@@ -374,13 +504,15 @@ class WardFactory:
             :py:class:`~VmtWard`
             :py:class:`~VcenterWard` (Incomplete)
         """
-        if self._unique_ward_key(config) not in self._ward_cache:
+        key = self._unique_ward_key(config)
+        ward = self._ward_cache.get(key)
+        if ward is None:
             if config['type'] == 'vmt':
                 ward = VmtWard(self._vmt, config)
-                self._ward_cache[self._unique_ward_key(config)] = ward
             else:
-                self._ward_cache[self._unique_ward_key(config)] = Ward()
-        return self._ward_cache[self._unique_ward_key(config)]
+                ward = Ward()
+            self._ward_cache[key] = ward
+        return ward
 
     def all_wards(self):
         """Return all cached instances of :py:class:`~Ward`."""
@@ -447,7 +579,9 @@ class Diagnostician:
         """Fetch additional patient information and render diagnosis.
 
         Makes an API call to fetch action history for the patient (Entity) and
-        uses that data to render a diagnosis.
+        uses that data to render a diagnosis. When `failureCount` is 1 and
+        `attemptCount` is not set, the state of the triggering action is
+        sufficient, and no API call is made.
 
         Arguments:
             vmt (:obj:`~vmtconnect.Connection`): A vmtconnect instance
@@ -460,30 +594,37 @@ class Diagnostician:
             diagnostician's ruleset, `False` otherwise.
         """
 
-        action_state = 1 if patient.actionState in ['FAILING', 'FAILED'] else 0
-        if self.failureCount == 1 and action_state:
-            diagnosed = True
+        action_state = 1 if patient.actionState in ('FAILING', 'FAILED') else 0
+        if self.failureCount == 1 and not self.attemptCount:
+            # A single failure is decided by the triggering action alone, no
+            # history is required.
+            diagnosed = bool(action_state)
         else:
             try:
                 events = patient.get_events(vmt, self.lookbackHours)
-                sortedEvents = sorted(
-                    events,
-                    key=lambda action: read_isodate(action.createTime))
-
                 if self.attemptCount:
-                    sortedEvents = sortedEvents[self.attemptCount*-1:]
-
-                failedActions = [
-                    a for a in sortedEvents
-                    if a.result and a.result.lower() == 'failed']
-        
-                umsg.log(f"{patient.name} - Failed Actions Count: {len(failedActions)+action_state}, Tolerable Failed Actions {self.failureCount}")
-                diagnosed = len(failedActions)+action_state >= self.failureCount
+                    # Reversed so ties keep the most recently listed events,
+                    # matching a slice of the tail of a stable sort.
+                    recentEvents = heapq.nlargest(
+                        self.attemptCount, reversed(events),
+                        key=operator.attrgetter('_sortKey'))
+                else:
+                    # Only the failure count matters, so order is irrelevant.
+                    recentEvents = events
+
+                failedCount = action_state
+                for action in recentEvents:
+                    if failedCount >= self.failureCount:
+                        break
+                    failedCount += action._failed
+
+                umsg.log(f"{patient.name} - Failed Actions Count: {failedCount}, Tolerable Failed Actions {self.failureCount}")
+                diagnosed = failedCount >= self.failureCount
                 # TODO: Implement class mixin for umsg correctly.
                 # if diagnosed:
                 #     umsg.log(
-                #         f"Patient {patient.uuid} diagnosed with {len(failedActions)} "
-                #         f"failed actions out of {len(sortedEvents)}", level="Debug")
+                #         f"Patient {patient.uuid} diagnosed with {failedCount} "
+                #         f"failed actions out of {len(recentEvents)}", level="Debug")
                 
             except IndexError:
                 umsg.log(f"{self.failureCount} failed actions required for admitting {patient.name}, but no events were returned in lookup")
@@ -523,6 +664,51 @@ class Diagnostician:
         return retval
 
 
+def quarantine_patient(diagnosticians: List[Diagnostician],
+                       vmt: vmtconnect.Connection, patient: Patient):
+    """Diagnose the patient with each diagnostician, and admit it to the wards
+    of every diagnostician whose criteria is met.
+
+    Admissions are collected per ward, so that diagnosticians sharing a ward
+    result in a single admit call for that ward. A diagnostician which raises
+    is logged and skipped, so it does not prevent admissions from the others.
+
+    Arguments:
+        diagnosticians (list): The :py:class:`~Diagnostician` rules to
+            consider.
+        vmt (:obj:`~vmtconnect.Connection`): A vmtconnect instance used to
+            request action history and entity details.
+        patient (:obj:`~Patient`): The patient (Entity) to consider.
+    """
+    admissions = defaultdict(list)
+    for diagnostician in diagnosticians:
+        try:
+            if not diagnostician.triage(patient):
+                continue
+            umsg.log(f"Patient {patient.name} needs to be diagnosed")
+            if not diagnostician.diagnose(vmt, patient):
+                continue
+        except Exception as e:
+            umsg.log(
+                f"Unable to diagnose {patient.name} for criteria - "
+                f"{diagnostician.criteria()}: {e}", exc_info=True,
+                level="Error")
+            continue
+
+        for ward in diagnostician.wards:
+            if patient not in admissions[ward]:
+                admissions[ward].append(patient)
+        umsg.log(
+            f"Quarantining {patient.name} matching criteria - "
+            f"{diagnostician.criteria()}")
+
+    if admissions:
+        patient.get_entity(vmt)
+        for ward, patients in admissions.items():
+            ward.admit_many(patients)
+        umsg.log(f"Quarantined {patient.name}")
+
+
 if __name__ == '__main__':
     parser = configargparse.ArgumentParser(
         description="Action script for quarantining Service Entities based on"
@@ -573,8 +759,7 @@ if __name__ == '__main__':
 
         ward_factory = WardFactory(vmtjit)
 
-        with open(args.config_file) as cfgfile:
-            config = yaml.load(cfgfile, Loader=yaml.FullLoader)
+        config = load_config(args.config_file)
 
         # Capture all of urllib3's warnings SSL verification
         logging.captureWarnings(True)
@@ -594,19 +779,11 @@ if __name__ == '__main__':
             umsg.log(
                 f"Processing POST action script for {entity_name}")
 
-            stdinDto = json.loads(sys.stdin.read())
+            stdinDto = read_json(sys.stdin.buffer.read())
             patient = Patient(stdinDto)
             seed(stdinDto['actionOid'])
             sleep(randrange(0,3000)/1000)
-            for diagnostician in diagnosticians:
-
-                if diagnostician.triage(patient):
-                    umsg.log(f"Patient {entity_name} needs to be diagnosed")
-                    if diagnostician.diagnose(vmtjit.get_session(), patient):
-                        patient.get_entity(vmtjit.get_session())
-                        diagnostician.admit(patient)
-                        umsg.log(
-                            f"Quarantined {entity_name} matching criteria - "
-                            f"{diagnostician.criteria()}")
+
+            quarantine_patient(diagnosticians, vmtjit.get_session(), patient)
     except Exception as e:
         umsg.log(f"Exception {e}", exc_info=True, level="Error")
@@ -1,3 +1,4 @@
+import os
 import uuid
 import json
 import logging
@@ -9,6 +10,12 @@ import pytest
 import vmtmock as vmtconnect
 import quarantine
 
+@pytest.fixture(autouse=True)
+def quiet_umsg(monkeypatch):
+    # umsg profiles are per calling module, and quarantine only initializes
+    # its profile when run as a script.
+    monkeypatch.setattr(umsg, 'log', lambda *args, **kwargs: None)
+
 def generate_action(actionType, createTime, actionState):
     return {
         "uuid": str(uuid.uuid4()),
@@ -23,6 +30,31 @@ def generate_failures(actionType, times=1, createTime=datetime.datetime.now()):
 def generate_successes(actionType, times=1, createTime=datetime.datetime.now()):
     return [generate_action(actionType, createTime, 'SUCCEEDED') for a in range(times)]
 
+def generate_asdto(entityUuid=None, actionState='SUCCEEDED'):
+    return {
+        "actionState": actionState,
+        "actionItem": [
+            {
+                "actionType": "MOVE",
+                "uuid": str(uuid.uuid4()),
+                "targetSE": {
+                    "turbonomicInternalId": entityUuid or str(uuid.uuid4()),
+                    "displayName": "vm"
+                }
+            }
+        ]
+    }
+
+def generate_group(name):
+    return {"uuid": str(uuid.uuid4()), "displayName": name}
+
+def generate_ward(responses, groupName='Quarantine'):
+    vmt = vmtconnect.Session(responses=responses)
+    vmtjit = quarantine.VmtJit()
+    vmtjit.vmt = vmt
+    config = {"type": "vmt", "groupName": groupName, "groupType": "VirtualMachine"}
+    return quarantine.VmtWard(vmtjit, config), vmt
+
 
 test_failures_in_a_row_data = [
     (2, None, [{"uuid": str(uuid.uuid4()), "actions": generate_failures('MOVE', 2)}], True),
@@ -32,28 +64,25 @@ test_failures_in_a_row_data = [
     (4, None, [{"uuid": str(uuid.uuid4()), "actions": generate_failures('MOVE', 4)}], True),
 ]
 
+tiedTime = datetime.datetime(2024, 1, 15, 12, 33, 20)
+
 test_failures_x_out_of_y_data = [
     (2, 3, [{"uuid": str(uuid.uuid4()), "actions": generate_successes('MOVE', 1) + generate_failures('MOVE', 2)}], True),
     (2, 5, [{"uuid": str(uuid.uuid4()), "actions": generate_successes('MOVE', 3) + generate_failures('MOVE', 2)}], True),
     (2, 5, [{"uuid": str(uuid.uuid4()), "actions": generate_successes('MOVE') + generate_failures('MOVE') + generate_successes('MOVE', 2) + generate_failures('MOVE')}], True),
+    # Equal createTimes keep the most recently listed attempts, as the tail of
+    # a stable sort would. The first two attempts alone would be diagnosed.
+    (2, 2, [{"uuid": str(uuid.uuid4()), "actions": generate_failures('MOVE', 2, tiedTime) + generate_successes('MOVE', 1, tiedTime)}], False),
+    # A single failure out of several attempts is found in the history
+    (1, 5, [{"uuid": str(uuid.uuid4()), "actions": generate_failures('MOVE', 3) + generate_successes('MOVE')}], True),
 ]
 
 @pytest.mark.parametrize("times,tries,payload,assertion", test_failures_in_a_row_data + test_failures_x_out_of_y_data)
 def test_failures_in_a_row(times, tries, payload, assertion):
     vmt = vmtconnect.Session(responses={
-        "request": [payload]
+        "request": [payload[0]["actions"]]
     })
-    asdto = {
-        "actionItem": [
-            {
-                "actionType": "MOVE",
-                "uuid": str(uuid.uuid4()),
-                "targetSE": {
-                    "turbonomicInternalId": str(uuid.uuid4())
-                }
-            }
-        ]
-    }
+    asdto = generate_asdto()
     rule = {
         "actionType": "MOVE",
         "entityType": "VIRTUAL_MACHINE",
@@ -63,3 +92,111 @@ def test_failures_in_a_row(times, tries, payload, assertion):
     }
     d = quarantine.Diagnostician(rule, quarantine.WardFactory(quarantine.VmtJit()))
     assert d.diagnose(vmt, quarantine.Patient(asdto)) == assertion
+
+
+def test_get_group_exact_match():
+    group = generate_group('Quarantine')
+    ward, vmt = generate_ward({
+        "search": [[generate_group('Quarantine-old'), group]]
+    })
+    assert ward._get_group() == group
+    assert not vmt.calls_to('add_static_group')
+
+def test_get_group_creates_when_only_substring_matches():
+    group = generate_group('Quarantine')
+    ward, vmt = generate_ward({
+        "search": [[generate_group('Quarantine-old')]],
+        "add_static_group": [[group]]
+    })
+    assert ward._get_group() == group
+    assert vmt.calls_to('add_static_group') == [(('Quarantine', 'VirtualMachine'), {})]
+
+def test_get_group_uuid_is_cached():
+    group = generate_group('Quarantine')
+    ward, vmt = generate_ward({"search": [[group]]})
+    assert ward._get_group_uuid() == group['uuid']
+    assert ward._get_group_uuid() == group['uuid']
+    assert len(vmt.calls_to('search')) == 1
+
+def test_discharge_many():
+    group = generate_group('Quarantine')
+    members = [{"uuid": str(uuid.uuid4())} for m in range(4)]
+    ward, vmt = generate_ward({
+        "search": [[group]],
+        "get_group_members": [members],
+        "update_static_group_members": [None]
+    })
+    patients = [quarantine.Patient(generate_asdto(m['uuid'])) for m in members[1:3]]
+    ward.discharge_many(patients)
+    assert len(vmt.calls_to('get_group_members')) == 1
+    assert vmt.calls_to('update_static_group_members') == [
+        ((group['uuid'], [members[0]['uuid'], members[3]['uuid']]), {})]
+
+def test_admit_many():
+    group = generate_group('Quarantine')
+    ward, vmt = generate_ward({
+        "search": [[group]],
+        "add_static_group_members": [None]
+    })
+    patients = [quarantine.Patient(generate_asdto()) for p in range(3)]
+    ward.admit_many(patients)
+    assert vmt.calls_to('add_static_group_members') == [
+        ((group['uuid'], [p.uuid for p in patients]), {})]
+
+def test_quarantine_patient_admits_once_per_ward():
+    group = generate_group('Quarantine')
+    ward, vmt = generate_ward({
+        "search": [[group]],
+        "get_entities": [[{"uuid": "e"}]],
+        "add_static_group_members": [None]
+    })
+    factory = quarantine.WardFactory(ward.vmtjit)
+    rule = {
+        "actionType": "MOVE",
+        "quarantineMethods": [{"type": "vmt", "groupName": "Quarantine", "groupType": "VirtualMachine"}]
+    }
+    diagnosticians = [quarantine.Diagnostician(rule, factory) for d in range(2)]
+    patient = quarantine.Patient(generate_asdto(actionState='FAILED'))
+    quarantine.quarantine_patient(diagnosticians, vmt, patient)
+    assert vmt.calls_to('add_static_group_members') == [
+        ((group['uuid'], [patient.uuid]), {})]
+
+def test_event_parses_create_time_lazily():
+    action = generate_action('MOVE', tiedTime, 'FAILED')
+    event = quarantine.Event(dict(action, createTime='2024-01-15T12:33:20Z'))
+    assert event._sortKey == datetime.datetime(
+        2024, 1, 15, 12, 33, 20, tzinfo=datetime.timezone.utc).timestamp()
+    # A malformed createTime only raises once the events are ordered
+    event = quarantine.Event(dict(action, createTime='bogus'))
+    with pytest.raises(ValueError):
+        event._sortKey
+
+def test_quarantine_patient_admits_when_later_diagnosis_raises():
+    group = generate_group('Quarantine')
+    ward, vmt = generate_ward({
+        "search": [[group]],
+        "request": [Exception('HTTP 500')],
+        "get_entities": [[{"uuid": "e"}]],
+        "add_static_group_members": [None]
+    })
+    factory = quarantine.WardFactory(ward.vmtjit)
+    methods = [{"type": "vmt", "groupName": "Quarantine", "groupType": "VirtualMachine"}]
+    diagnosticians = [
+        quarantine.Diagnostician({"actionType": "MOVE", "failureCount": 1, "quarantineMethods": methods}, factory),
+        quarantine.Diagnostician({"actionType": "MOVE", "failureCount": 3, "quarantineMethods": methods}, factory)
+    ]
+    patient = quarantine.Patient(generate_asdto(actionState='FAILED'))
+    quarantine.quarantine_patient(diagnosticians, vmt, patient)
+    assert len(vmt.calls_to('request')) == 1
+    assert vmt.calls_to('add_static_group_members') == [
+        ((group['uuid'], [patient.uuid]), {})]
+
+def test_load_config_returns_copies_and_reloads(tmp_path):
+    cfg = tmp_path / 'config.yaml'
+    cfg.write_text("quarantineRules:\n- actionType: MOVE\n")
+    config = quarantine.load_config(str(cfg))
+    config['quarantineRules'].append({"actionType": "RESIZE"})
+    assert quarantine.load_config(str(cfg)) == {"quarantineRules": [{"actionType": "MOVE"}]}
+    cfg.write_text("quarantineRules: []\n")
+    os.utime(cfg, ns=(0, 0))
+    assert quarantine.load_config(str(cfg)) == {"quarantineRules": []}
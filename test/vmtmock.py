@@ -1,11 +1,25 @@
 class Session:
     def __init__(self, *args, **kwargs):
         self.__responses = kwargs['responses']
-        self.__callcount = {k:0 for k in self.__responses.keys()}
+        self.calls = []
 
     def __getattr__(self, name):
+        try:
+            responses = self.__responses[name]
+        except KeyError:
+            raise AttributeError(name)
+        callcount = [0]
+
         def foo(*args, **kwargs):
-            curidx = self.__callcount[name]
-            self.__callcount[name] = self.__callcount[name] + 1
-            return self.__responses[name][curidx]
+            self.calls.append((name, args, kwargs))
+            curidx = callcount[0]
+            callcount[0] = curidx + 1
+            if isinstance(responses[curidx], Exception):
+                raise responses[curidx]
+            return responses[curidx]
+        # Cache on the instance so later lookups bypass __getattr__
+        object.__setattr__(self, name, foo)
         return foo
+
+    def calls_to(self, name):
+        return [(args, kwargs) for n, args, kwargs in self.calls if n == name]